@@ -1,10 +1,13 @@
+import asyncio
 import logging
-import traceback
-from tempfile import NamedTemporaryFile
-from string import Template as StringTemplate
+import re
+import time
+import weakref
+from collections import OrderedDict
 
+import httpx
 from decouple import config
-from telegram import Update, ReplyKeyboardMarkup
+from telegram import Message, Update, ReplyKeyboardMarkup
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -12,11 +15,12 @@ from telegram.ext import (
     filters,
     ContextTypes,
     ConversationHandler,
+    TypeHandler,
 )
 
 from mindee import ClientV2, InferencePredictOptions
 from mindee.parsing.v2 import InferenceResponse
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 # Load tokens
 TG_TOKEN = config("TELEGRAM_TOKEN")
@@ -27,21 +31,73 @@ AI_TOKEN = config("OPEN_ROUTER_API")
 
 # Initialize clients
 mindee_client = ClientV2(MINDEE_API_KEY)
-ai_client = OpenAI(
+ai_client = AsyncOpenAI(
   base_url="https://openrouter.ai/api/v1",
   api_key=f"{AI_TOKEN}",
+  # Pooled keep-alive HTTP/2 connections reused across AI calls
+  http_client=httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_keepalive_connections=20, keepalive_expiry=30),
+  ),
 )
 
+# Non-reasoning chat model; answers here are short and need no chain-of-thought
+AI_MODEL = "deepseek/deepseek-chat-v3-0324:free"
+AI_MAX_TOKENS = 200
+
+# Seconds between edits of a streamed AI reply (Telegram allows ~1 message/s per chat)
+STREAM_EDIT_INTERVAL = 1.0
+
 # State definitions
 ASK_PASSPORT, ASK_CAR_DOC, CONFIRM_DATA, PRICE_CONFIRM, PRICE_RECONFIRM, AFTER_POLICY = range(6)
 
-# In-memory data
-user_data_storage = {}
+# Idle conversations are ended and their user data dropped after this many seconds
+CONVERSATION_TIMEOUT = 600
+
+# Seconds Telegram holds a getUpdates request open while waiting for updates
+POLLING_TIMEOUT = 50
+
+# Keyword vocabularies for free-text replies
+_WORD_RE = re.compile(r"\w+")
+_AI_TRIGGER_WORDS = frozenset({"навіщо", "чому"})
+_AI_TRIGGER_PHRASES = ("для чого", "а якщо", "чи потрібно")
+_PRICE_TRIGGER_WORDS = frozenset({"чому", "можна"})
+_PRICE_TRIGGER_STEMS = ("дешев",)
+_RESPONSE_CLASS = {
+    "так": "yes", "згоден": "yes", "добре": "yes", "ок": "yes",
+    "ні": "no", "не згоден": "no", "ніт": "no",
+}
+_THANKS_WORDS = frozenset({"дякую"})
+
+
+def _tokens(text: str) -> set[str]:
+    return set(_WORD_RE.findall(text))
+
+
+# Per-user locks so concurrent car photos hand off the passport task one at a time.
+# Entries disappear once no handler holds or waits on the lock.
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _get_user_lock(user_id: int) -> asyncio.Lock:
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = _user_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+# Cached AI explanations about the fixed price
+PRICE_EXPLANATION_TIMEOUT = 30
+_price_explanation_cache: str | None = None
+_price_explanation_task: asyncio.Task | None = None
+_RECONFIRM_CACHE_SIZE = 128
+_reconfirm_answer_cache: OrderedDict[str, str] = OrderedDict()
 
 # Logging
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
+log = logging.getLogger(__name__)
 
 
 # Starting message
@@ -55,8 +111,47 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ASK_PASSPORT
 
 
+# Streaming an AI answer into a reply that is edited as tokens arrive
+async def stream_ai_reply(message: Message, messages: list[dict], **options) -> str:
+    stream = await ai_client.chat.completions.create(
+        model=AI_MODEL,
+        messages=messages,
+        max_tokens=AI_MAX_TOKENS,
+        stream=True,
+        **options,
+    )
+
+    reply = None
+    text = ""
+    shown = ""
+    last_edit = time.monotonic()
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        text += chunk.choices[0].delta.content or ""
+
+        visible = text.strip()
+        if not visible:
+            continue
+        if reply is None:
+            reply = await message.reply_text(visible)
+            shown = visible
+            last_edit = time.monotonic()
+        elif visible != shown and time.monotonic() - last_edit >= STREAM_EDIT_INTERVAL:
+            await reply.edit_text(visible)
+            shown = visible
+            last_edit = time.monotonic()
+
+    text = text.strip()
+    if reply is None:
+        raise ValueError("Empty AI response")
+    if text != shown:
+        await reply.edit_text(text)
+    return text
+
+
 # Additional AI interactions
-async def answer_user_question_with_ai(user_question: str) -> str:
+async def answer_user_question_with_ai(message: Message, user_question: str):
     try:
         system_message = (
             "Ти — ввічливий Telegram-бот (Але не надо, тобто без використання емодзі), що допомагає людям купити автострахування. "
@@ -68,55 +163,99 @@ async def answer_user_question_with_ai(user_question: str) -> str:
             f"Як би ти відповів, якщо зараз бот очікує, наприклад, фото паспорта або авто (без привітань)?"
         )
 
-        response = ai_client.chat.completions.create(
-            model="deepseek/deepseek-r1:free",
-            messages=[
+        await stream_ai_reply(
+            message,
+            [
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": user_prompt},
             ],
-            temperature=0.7
+            temperature=0.3,
         )
-        return response.choices[0].message.content.strip()
-    except Exception as e:
-        print("AI error:", e)
-        return "Вибачте, щось пішло не так з відповіддю. Спробуйте ще раз."
+    except Exception:
+        log.exception("AI answer to user question failed")
+        await message.reply_text("Вибачте, щось пішло не так з відповіддю. Спробуйте ще раз.")
 
 
 # Additional AI interactions
 async def ask_ai_about_price():
-    try:
-        response = ai_client.chat.completions.create(
-            model="deepseek/deepseek-r1:free",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Ти ввічливий страховий бот, але не використовуй емодзі. Поясни, чому ціна фіксована — дуже коротко та не дозволяй тогруватися (щось накшталт в компанії поки що немає інших варіантів), українською мовою.",
-                },
-                {
-                    "role": "user",
-                    "content": "Чому ціна на автострахування фіксована?",
-                }
-            ],
+    global _price_explanation_cache, _price_explanation_task
+    if _price_explanation_cache is not None:
+        return _price_explanation_cache
+
+    # Concurrent callers share one in-flight request and get the same result or failure
+    if _price_explanation_task is None:
+        _price_explanation_task = asyncio.create_task(
+            asyncio.wait_for(_request_price_explanation(), PRICE_EXPLANATION_TIMEOUT)
         )
-        return response.choices[0].message.content.strip()
-
-    except Exception as e:
-        print("AI error:", e)
+    task = _price_explanation_task
+    try:
+        _price_explanation_cache = await asyncio.shield(task)
+        return _price_explanation_cache
+    except Exception:
+        log.exception("AI price explanation failed")
         return "Ціна, на жаль, фіксована через стандартизований тариф для всіх клієнтів."
+    finally:
+        if _price_explanation_task is task and task.done():
+            _price_explanation_task = None
+
+
+async def _request_price_explanation():
+    response = await ai_client.chat.completions.create(
+        model=AI_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": "Ти ввічливий страховий бот, але не використовуй емодзі. Поясни, чому ціна фіксована — дуже коротко та не дозволяй тогруватися (щось накшталт в компанії поки що немає інших варіантів), українською мовою.",
+            },
+            {
+                "role": "user",
+                "content": "Чому ціна на автострахування фіксована?",
+            }
+        ],
+        max_tokens=AI_MAX_TOKENS,
+        stream=False,
+    )
+    return response.choices[0].message.content.strip()
+
+
+# Explaining the fixed price for a free-form reply, cached per normalized phrase
+async def ask_ai_about_reconfirm(message: Message, user_input: str):
+    key = " ".join(user_input.split())
+    if key in _reconfirm_answer_cache:
+        _reconfirm_answer_cache.move_to_end(key)
+        await message.reply_text(_reconfirm_answer_cache[key])
+        return
+
+    prompt = (
+        f"Клієнт питає: '{key}'. "
+        "Поясни коротко українською, чому ціна на автострахування фіксована — 100 USD. "
+        "Скажи, що це базовий поліс і він охоплює стандартні ризики. "
+        "Не змінюй ціну, але відповідай доброзичливо."
+    )
+
+    answer = await stream_ai_reply(
+        message,
+        [
+            {"role": "system", "content": "Ти — ввічливий консультант страхового сервісу. Відповідай українською."},
+            {"role": "user", "content": prompt}
+        ],
+    )
+
+    _reconfirm_answer_cache[key] = answer
+    if len(_reconfirm_answer_cache) > _RECONFIRM_CACHE_SIZE:
+        _reconfirm_answer_cache.popitem(last=False)
 
 
 # Downloading photo
 async def download_photo(file, context):
     tg_file = await context.bot.get_file(file.file_id)
-    with NamedTemporaryFile(delete=False, suffix=".jpg") as f:
-        await tg_file.download_to_drive(custom_path=f.name)
-        return f.name
+    return await tg_file.download_as_bytearray()
 
 
 # Extracting passport data using Mindee API
-def extract_passport_data(image_path):
+def _sync_extract_passport(image_bytes):
     try:
-        input_source = mindee_client.source_from_path(image_path)
+        input_source = mindee_client.source_from_bytes(bytes(image_bytes), "photo.jpg")
         options = InferencePredictOptions(model_id=PASSPORT_MODEL_ID, rag=False)
         response: InferenceResponse = mindee_client.enqueue_and_parse(input_source, options)
         fields = response.inference.result.fields
@@ -136,8 +275,8 @@ def extract_passport_data(image_path):
             "passport_number": passport_number
         }
 
-    except Exception as e:
-        print("Mindee passport extraction error:", e)
+    except Exception:
+        log.exception("Mindee passport extraction failed")
         return {
             "full_name": "Unknown",
             "passport_number": "Unknown"
@@ -145,9 +284,9 @@ def extract_passport_data(image_path):
 
 
 # Extracting vin data using Mindee API
-def extract_vehicle_data(image_path):
+def _sync_extract_vehicle(image_bytes):
     try:
-        input_source = mindee_client.source_from_path(image_path)
+        input_source = mindee_client.source_from_bytes(bytes(image_bytes), "photo.jpg")
 
         options = InferencePredictOptions(
             model_id=VEHICLE_MODEL_ID,
@@ -157,7 +296,6 @@ def extract_vehicle_data(image_path):
         response: InferenceResponse = mindee_client.enqueue_and_parse(input_source, options)
 
         fields = response.inference.result.fields
-        print("VEHICLE fields:", fields)
 
         car_model_field = fields.get("car_model")
         car_model = car_model_field.value if car_model_field else "Unknown"
@@ -174,8 +312,8 @@ def extract_vehicle_data(image_path):
             "vin_number": vin_number
         }
 
-    except Exception as e:
-        print("Mindee vehicle extraction error:", e)
+    except Exception:
+        log.exception("Mindee vehicle extraction failed")
         return {
             "car_brand": "Unknown",
             "car_model": "Unknown",
@@ -183,17 +321,22 @@ def extract_vehicle_data(image_path):
         }
 
 
+# Running blocking Mindee calls in a worker thread so the event loop stays free
+async def extract_passport_data(image_bytes):
+    return await asyncio.to_thread(_sync_extract_passport, image_bytes)
+
+
+async def extract_vehicle_data(image_bytes):
+    return await asyncio.to_thread(_sync_extract_vehicle, image_bytes)
+
+
 # Receiving passport data
 async def receive_passport(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo = update.message.photo[-1]
-    image_path = await download_photo(photo, context)
+    image_bytes = await download_photo(photo, context)
 
-    extracted = extract_passport_data(image_path)
-
-    user_data_storage[update.message.from_user.id] = {
-        "passport_photo": image_path,
-        "extracted": extracted
-    }
+    # Passport extraction runs in the background while the user sends the car document
+    context.user_data["passport_task"] = asyncio.create_task(extract_passport_data(image_bytes))
 
     await update.message.reply_text("Дякую! Тепер, будь ласка, надішліть фото документа на авто.")
     return ASK_CAR_DOC
@@ -202,14 +345,21 @@ async def receive_passport(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Receiving vin data
 async def receive_car_doc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     photo = update.message.photo[-1]
-    image_path = await download_photo(photo, context)
-    car_data = extract_vehicle_data(image_path)
-
-    user_id = update.message.from_user.id
-    user_data_storage[user_id]["car_doc"] = image_path
-    user_data_storage[user_id]["extracted"].update(car_data)
-
-    data = user_data_storage[user_id]["extracted"]
+    image_bytes = await download_photo(photo, context)
+
+    vehicle_task = asyncio.create_task(extract_vehicle_data(image_bytes))
+    async with _get_user_lock(update.message.from_user.id):
+        passport_task = context.user_data.pop("passport_task", None)
+        if passport_task is not None:
+            passport_data, car_data = await asyncio.gather(passport_task, vehicle_task)
+        elif "extracted" in context.user_data:
+            # Another car photo already consumed the passport result; keep its passport fields
+            passport_data, car_data = context.user_data["extracted"], await vehicle_task
+        else:
+            vehicle_task.cancel()
+            await update.message.reply_text("Будь ласка, спочатку надішліть фото паспорта.")
+            return ASK_PASSPORT
+        data = context.user_data["extracted"] = {**passport_data, **car_data}
 
     confirmation_msg = (
         f"Ось що я знайшов:\n"
@@ -229,7 +379,8 @@ async def receive_car_doc(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Data confirmation logic
 async def confirm_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.text.lower() == "так":
+    user_text = (update.message.text or "").strip().casefold()
+    if user_text == "так":
         reply_keyboard = [["Так", "Ні"]]
         await update.message.reply_text("Ціна страховки становить 100 USD. Приймаєте?",
                                         reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True))
@@ -241,9 +392,10 @@ async def confirm_data(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Price confirmation logic
 async def handle_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_text = update.message.text.lower()
+    user_text = (update.message.text or "").strip().casefold()
 
-    if "чому" in user_text or "можна" in user_text or "дешев" in user_text:
+    tokens = _tokens(user_text)
+    if tokens & _PRICE_TRIGGER_WORDS or any(token.startswith(_PRICE_TRIGGER_STEMS) for token in tokens):
         explanation = await ask_ai_about_price()
         await update.message.reply_text(explanation)
         reply_keyboard = [["Так", "Ні"]]
@@ -266,34 +418,21 @@ async def handle_price(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # Continuation of confirmation logic
 async def handle_reconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_input = update.message.text.lower().strip()
+    user_text = (update.message.text or "").strip().casefold()
+
+    response_class = _RESPONSE_CLASS.get(user_text)
 
-    if user_input in ["так", "згоден", "добре", "ок"]:
+    if response_class == "yes":
         return await issue_policy(update, context)
 
-    elif user_input in ["ні", "не згоден", "ніт"]:
+    elif response_class == "no":
         await update.message.reply_text("Добре. Сподіваюся побачити вас наступного разу!")
+        context.user_data.clear()
         return ConversationHandler.END
 
     else:
         try:
-            prompt = (
-                f"Клієнт питає: '{user_input}'. "
-                "Поясни коротко українською, чому ціна на автострахування фіксована — 100 USD. "
-                "Скажи, що це базовий поліс і він охоплює стандартні ризики. "
-                "Не змінюй ціну, але відповідай доброзичливо."
-            )
-
-            ai_response = ai_client.chat.completions.create(
-                model="deepseek/deepseek-r1:free",
-                messages=[
-                    {"role": "system", "content": "Ти — ввічливий консультант страхового сервісу. Відповідай українською."},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-
-            answer = ai_response.choices[0].message.content.strip()
-            await update.message.reply_text(answer)
+            await ask_ai_about_reconfirm(update.message, user_text)
 
             reply_keyboard = [["Так", "Ні"]]
             await update.message.reply_text(
@@ -302,42 +441,36 @@ async def handle_reconfirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return PRICE_RECONFIRM
 
-        except Exception as e:
-            logging.error(f"AI error in reconfirm: {e}")
+        except Exception:
+            log.exception("AI error in reconfirm")
             await update.message.reply_text("На жаль, зараз не можу відповісти. Спробуйте трохи пізніше.")
             return PRICE_RECONFIRM
 
 
-# Sending the result
-async def issue_policy(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = user_data_storage[update.message.from_user.id]["extracted"]
-
-    template_text = """
-Страховий Поліс
+# Policy document text
+def _render_policy(data):
+    return f"""Страховий Поліс
 
-Ім'я застрахованого: $full_name
-Номер паспорта: $passport_number
-Автомобіль: $car_brand $car_model
-VIN: $vin_number
+Ім'я застрахованого: {data.get("full_name", "Unknown")}
+Номер паспорта: {data.get("passport_number", "Unknown")}
+Автомобіль: {data.get("car_brand", "Unknown")} {data.get("car_model", "Unknown")}
+VIN: {data.get("vin_number", "Unknown")}
 
 Сума до сплати: 100 USD
 
-Цей документ є підтвердженням оформлення автострахування.
-    """
-    template = StringTemplate(template_text)
-    policy_text = template.substitute(
-        full_name=data.get("full_name", "Unknown"),
-        passport_number=data.get("passport_number", "Unknown"),
-        car_brand=data.get("car_brand", "Unknown"),
-        car_model=data.get("car_model", "Unknown"),
-        vin_number=data.get("vin_number", "Unknown"),
-    )
+Цей документ є підтвердженням оформлення автострахування."""
+
+
+# Sending the result
+async def issue_policy(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    data = context.user_data["extracted"]
 
-    await update.message.reply_text("✅ Страховий поліс створено. Ось ваш документ:")
-    await update.message.reply_text(policy_text.strip())
+    policy_text = _render_policy(data)
 
     reply_keyboard = [["Дякую", "Створити ще один поліс"]]
     await update.message.reply_text(
+        "✅ Страховий поліс створено. Ось ваш документ:\n\n"
+        f"{policy_text}\n\n"
         "Бажаєте створити ще один страховий поліс?",
         reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True),
     )
@@ -346,9 +479,10 @@ VIN: $vin_number
 
 # Alternative ending
 async def after_policy(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    text = update.message.text.lower()
-    if "дякую" in text:
+    user_text = (update.message.text or "").strip().casefold()
+    if _tokens(user_text) & _THANKS_WORDS:
         await update.message.reply_text("Дякую за використання бота! До зустрічі.")
+        context.user_data.clear()
         return ConversationHandler.END
     else:
         return await start(update, context)
@@ -357,29 +491,39 @@ async def after_policy(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # /cancel command logic
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Скасовано. Для початку введіть /start")
+    context.user_data.clear()
     return ConversationHandler.END
 
 
+# Dropping the state of an abandoned conversation
+async def conversation_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    context.user_data.clear()
+
+
 # Unscripted user input
 async def handle_unexpected_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_message = update.message.text.lower()
-    if any(word in user_message for word in ["навіщо", "чому", "для чого", "а якщо", "чи потрібно"]):
-        ai_reply = await answer_user_question_with_ai(update.message.text)
-        await update.message.reply_text(ai_reply)
+    user_text = (update.message.text or "").strip().casefold()
+    if _tokens(user_text) & _AI_TRIGGER_WORDS or any(phrase in user_text for phrase in _AI_TRIGGER_PHRASES):
+        await answer_user_question_with_ai(update.message, update.message.text)
     else:
         await update.message.reply_text("Я очікую фото. Будь ласка, надішліть фото, як було запрошено.")
 
 
 # In case of errors
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
-    logging.error("Unhandled exception: %s", traceback.format_exc())
+    log.error("Unhandled exception", exc_info=context.error)
     if isinstance(update, Update) and update.message:
         await update.message.reply_text("Сталася помилка(( Спробуйте ще раз або введіть /start")
 
 
+# Closing pooled AI connections on shutdown
+async def close_ai_client(application):
+    await ai_client.close()
+
+
 # Running the bot
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(TG_TOKEN).build()
+    app = ApplicationBuilder().token(TG_TOKEN).post_shutdown(close_ai_client).build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
@@ -396,10 +540,13 @@ if __name__ == "__main__":
             PRICE_CONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_price)],
             PRICE_RECONFIRM: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_reconfirm)],
             AFTER_POLICY: [MessageHandler(filters.TEXT & ~filters.COMMAND, after_policy)],
+            ConversationHandler.TIMEOUT: [TypeHandler(Update, conversation_timeout)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
     app.add_handler(conv_handler)
     app.add_error_handler(error_handler)
-    app.run_polling()
\ No newline at end of file
+    # Long polling with Telegram's maximum getUpdates timeout
+    app.run_polling(timeout=POLLING_TIMEOUT, poll_interval=0.0)
\ No newline at end of file